@@ -1,25 +1,145 @@
 from flask import Flask, render_template, request, session, redirect, url_for
+from flask_caching import Cache
+import numpy as np
 import pandas as pd
+import redis
+import hashlib
+import io
+import json
 import os
-from smart_scheduler import time_to_minutes, build_busy_map, expected_columns
-from datetime import datetime, date
-from collections import defaultdict
+import sqlite3
+from smart_scheduler import time_to_minutes, build_busy_map, expected_columns, busy_intervals, find_free_slots
+from datetime import datetime, date, time, timedelta
+from functools import lru_cache
+from contextlib import closing, suppress
 
 app = Flask(__name__)
 app.secret_key = 'super_secret_key'  # Change in production
+redis_url = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+redis_client = redis.Redis.from_url(redis_url)
+cache = Cache(app, config={"CACHE_TYPE": "RedisCache", "CACHE_REDIS_URL": redis_url, "CACHE_DEFAULT_TIMEOUT": 300})
 
 # Excel path
 excel_path = os.path.join(os.path.dirname(__file__), "faculty_timetable.xlsx")
 
-# In-memory temporary changes: {(faculty, date_str): DataFrame}
-temp_sheets = {}
+# Temporary changes live in Redis as "tmp:<faculty>:<date>" -> DataFrame JSON,
+# expiring at the end of that date
+
+# Parsed busy maps for original sheets: {faculty: busy_map}
+busy_cache = {}
+
+# SQLite copy of the Excel file, reused while the file's mtime is unchanged.
+# Each sheet is stored as table sheet_<n> with every cell as tagged JSON text, so
+# times, timestamps and numbers read back exactly as pd.read_excel returned them;
+# sheet_names keeps workbook order and sheet_columns the column names and dtypes.
+sheets_db_path = os.path.splitext(excel_path)[0] + ".sqlite"
+
+def encode_cell(v):
+    if isinstance(v, pd.Timestamp):
+        return json.dumps({"timestamp": v.isoformat()})
+    if isinstance(v, datetime):
+        return json.dumps({"datetime": v.isoformat()})
+    if isinstance(v, time):
+        return json.dumps({"time": v.isoformat()})
+    return json.dumps(v)
+
+def decode_cell(text):
+    v = json.loads(text)
+    if isinstance(v, dict):
+        if "timestamp" in v:
+            return pd.Timestamp(v["timestamp"])
+        if "datetime" in v:
+            return datetime.fromisoformat(v["datetime"])
+        return time.fromisoformat(v["time"])
+    return v
+
+def read_sheets_db(path):
+    """Return (mtime, sheets) stored in a sheet cache database."""
+    with closing(sqlite3.connect(path)) as conn:
+        (mtime,) = conn.execute("SELECT mtime FROM source").fetchone()
+        sheets = {}
+        for position, name in conn.execute("SELECT position, name FROM sheet_names ORDER BY position").fetchall():
+            columns = conn.execute(
+                "SELECT name, dtype FROM sheet_columns WHERE position = ? ORDER BY idx", (position,)
+            ).fetchall()
+            rows = conn.execute(f"SELECT * FROM sheet_{position} ORDER BY row").fetchall()
+            df = pd.DataFrame({
+                i: pd.Series([decode_cell(row[i + 1]) for row in rows], dtype=object).astype(dtype)
+                for i, (_, dtype) in enumerate(columns)
+            }, index=pd.RangeIndex(len(rows)))
+            df.columns = [decode_cell(col) for col, _ in columns]
+            sheets[name] = df
+        return mtime, sheets
+
+def same_timetable(cached, df):
+    """True if a sheet read back from the cache matches the one parsed from Excel."""
+    if not (cached.equals(df) and list(cached.columns) == list(df.columns) and cached.dtypes.equals(df.dtypes)):
+        return False
+    try:
+        expected = build_busy_map(df)
+    except ValueError:
+        return True
+    got = build_busy_map(cached)
+    return all(np.array_equal(got[day], expected[day]) for day in expected)
+
+def load_cached_sheets(mtime):
+    if not os.path.exists(sheets_db_path):
+        return None
+    try:
+        cached_mtime, sheets = read_sheets_db(sheets_db_path)
+        if cached_mtime == mtime:
+            return sheets
+    except Exception as e:
+        print(f"Ignoring unreadable sheet cache: {e}")
+    return None
+
+def save_cached_sheets(mtime, sheets):
+    tmp_path = f"{sheets_db_path}.{os.getpid()}.tmp"
+    try:
+        # A leftover from a failed write (same pid after a restart) would already have the tables
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        with closing(sqlite3.connect(tmp_path)) as conn:
+            conn.execute("CREATE TABLE source (mtime REAL)")
+            conn.execute("INSERT INTO source VALUES (?)", (mtime,))
+            conn.execute("CREATE TABLE sheet_names (position INTEGER PRIMARY KEY, name TEXT)")
+            conn.execute("CREATE TABLE sheet_columns (position INTEGER, idx INTEGER, name TEXT, dtype TEXT)")
+            for position, (name, df) in enumerate(sheets.items()):
+                conn.execute("INSERT INTO sheet_names VALUES (?, ?)", (position, name))
+                conn.executemany(
+                    "INSERT INTO sheet_columns VALUES (?, ?, ?, ?)",
+                    [(position, i, encode_cell(col), str(dtype)) for i, (col, dtype) in enumerate(df.dtypes.items())],
+                )
+                cells = ", ".join(f"c{i}" for i in range(df.shape[1]))
+                conn.execute(f"CREATE TABLE sheet_{position} (row INTEGER PRIMARY KEY{', ' if cells else ''}{cells})")
+                # tolist() yields plain Python scalars, which json can encode
+                columns = [df.iloc[:, i].tolist() for i in range(df.shape[1])]
+                conn.executemany(
+                    f"INSERT INTO sheet_{position} VALUES ({', '.join(['?'] * (df.shape[1] + 1))})",
+                    ([row] + [encode_cell(col[row]) for col in columns] for row in range(len(df))),
+                )
+            conn.commit()
+        _, cached = read_sheets_db(tmp_path)
+        for name, df in sheets.items():
+            if not same_timetable(cached[name], df):
+                raise ValueError(f"sheet {name!r} does not round-trip through the cache")
+        os.replace(tmp_path, sheets_db_path)
+    except Exception as e:
+        print(f"Could not write sheet cache: {e}")
+        with suppress(OSError):
+            os.remove(tmp_path)
 
 # Load original timetables
 def load_sheets():
     try:
+        mtime = os.path.getmtime(excel_path)
+        sheets = load_cached_sheets(mtime)
+        if sheets:
+            return sheets
         sheets = pd.read_excel(excel_path, sheet_name=None)
         if not sheets:
             raise ValueError("Excel file is empty or has no valid sheets.")
+        save_cached_sheets(mtime, sheets)
         return sheets
     except Exception as e:
         print(f"Error loading Excel file: {e}")
@@ -27,6 +147,28 @@ def load_sheets():
 
 sheets = load_sheets()
 
+def workbook_fingerprint():
+    """Identifies the loaded timetables, so shared cache entries from another load are not reused."""
+    try:
+        mtime = os.path.getmtime(excel_path)
+    except OSError:
+        mtime = None
+    payload = json.dumps([mtime, list(sheets)])
+    return hashlib.sha1(payload.encode()).hexdigest()[:12]
+
+sheets_fingerprint = workbook_fingerprint()
+
+# Parse busy maps up front so that, under gunicorn --preload, workers share them
+# copy-on-write with the original sheets; a bad sheet still errors per request
+for name, df in sheets.items():
+    try:
+        busy_cache[name] = build_busy_map(df)
+    except ValueError as e:
+        print(f"Error parsing timetable for {name}: {e}")
+
+# Same for the slot-search kernel: compile (or load numba's on-disk cache) once here
+find_free_slots(np.empty((0, 2), dtype=np.int64), 0, 60, 15)
+
 # Time formatting
 def to_hhmm(minutes):
     if minutes is None:
@@ -37,6 +179,10 @@ def to_hhmm(minutes):
     h = h if 1 <= h <= 12 else (h - 12 if h > 12 else 12)
     return f"{h}:{m:02d} {ampm}"
 
+# Labels for every minute offset a slot can start or end at
+HHMM_TABLE = [to_hhmm(m) for m in range(24 * 60 + 1)]
+
+@lru_cache(maxsize=1024)
 def to_12hour(t):
     """Convert time string to 12-hour format, handle NaN/None."""
     if pd.isna(t) or t is None or str(t).strip() == "":
@@ -57,19 +203,45 @@ print("Registered to_12hour filter")
 def join_time(hour, minute, ampm):
     return f"{hour}:{minute} {ampm}"
 
-def clear_expired_temp_sheets():
-    """Remove temporary edits for past dates."""
-    current_date = date.today()
-    keys_to_remove = [
-        key for key, df in temp_sheets.items()
-        if datetime.strptime(key[1], '%Y-%m-%d').date() < current_date
-    ]
-    for key in keys_to_remove:
-        del temp_sheets[key]
+def temp_sheet_key(faculty, date_str):
+    return f"tmp:{faculty}:{date_str}"
+
+def end_of_date(date_str):
+    """Moment date_str ends, when its temporary edits stop applying."""
+    return datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=1)
+
+def save_temp_sheet(faculty, date_str, df):
+    """Store a temporary edit until the end of its date; returns False if that date is already past."""
+    expires = end_of_date(date_str)
+    if expires <= datetime.now():
+        return False
+    redis_client.set(temp_sheet_key(faculty, date_str), df.to_json(orient="split"), exat=int(expires.timestamp()))
+    return True
+
+def decode_temp_sheet(payload):
+    return pd.read_json(io.StringIO(payload.decode()), orient="split", dtype=False, convert_dates=False)
+
+def get_temp_payloads(faculties, date_str):
+    """Fetch the serialized temporary edits for the date in one round trip: {faculty: bytes or None}."""
+    payloads = redis_client.mget([temp_sheet_key(f, date_str) for f in faculties])
+    return dict(zip(faculties, payloads))
+
+@lru_cache(maxsize=64)
+def temp_busy_map(payload):
+    """Busy map for a temporary edit, keyed by its serialized content."""
+    return build_busy_map(decode_temp_sheet(payload))
+
+def get_busy_map(faculty, payload=None):
+    """Return the cached busy map for a faculty, preferring a temporary edit if one is given."""
+    if payload is not None:
+        return temp_busy_map(payload)
+    if faculty not in busy_cache:
+        busy_cache[faculty] = build_busy_map(sheets[faculty])
+    return busy_cache[faculty]
 
 @app.route("/", methods=["GET", "POST"])
+@cache.cached(key_prefix=lambda: f"index:{sheets_fingerprint}:{date.today()}", unless=lambda: request.method != "GET")
 def index():
-    clear_expired_temp_sheets()
     teachers = list(sheets.keys())
     today = datetime.now().strftime('%Y-%m-%d')
     if not teachers:
@@ -96,7 +268,8 @@ def edit():
     date_str = session['form_data']['date'][0]
     if faculty not in sheets:
         return "Faculty not found", 404
-    df = temp_sheets.get((faculty, date_str), sheets[faculty])
+    payload = redis_client.get(temp_sheet_key(faculty, date_str))
+    df = decode_temp_sheet(payload) if payload is not None else sheets[faculty]
     df = df.fillna('')  # Remove NaN
     columns = df.columns.tolist()
     rows = df.to_dict('records')
@@ -108,34 +281,68 @@ def save_edit(faculty):
         return "Faculty not found", 404
     date_str = session['form_data']['date'][0]
     columns = expected_columns
-    data = defaultdict(dict)
-    deleted = set()
+    deleted = {key.split('_', 1)[1] for key in request.form if key.startswith('delete_')}
+
+    # Fields are named "<column>_<row>"; pivot them back into rows in form order
+    cells = [(*key.rsplit('_', 1), value) for key, value in request.form.items()
+             if '_' in key and not key.startswith('delete_')]
+    cells_df = pd.DataFrame(cells, columns=['col', 'idx', 'val'])
+    kept = [idx for idx in cells_df['idx'].unique() if idx not in deleted]
+    new_df = (
+        cells_df.pivot(index='idx', columns='col', values='val')
+        .reindex(index=kept, columns=columns)
+        .fillna('')
+        .rename_axis(index=None, columns=None)
+        .reset_index(drop=True)
+    )
+    if not save_temp_sheet(faculty, date_str, new_df):
+        return "Cannot edit timetables for a past date", 400
+
+    return render_template("select_faculty.html", teachers=session['selected_teachers'])
 
-    for key in request.form:
-        if key.startswith('delete_'):
-            del_idx = key.split('_', 1)[1]
-            deleted.add(del_idx)
+def search_slots(selected_teachers, temp_payloads, day, duration, ws_min, we_min):
+    """Find free slots in the window, or the 5 closest ones in a ±2 hour extended window."""
+    alternative_slots = []
 
-    for key, value in request.form.items():
-        if '_' in key and not key.startswith('delete_'):
-            col, idx = key.rsplit('_', 1)
-            data[idx][col] = value
+    # Build busy maps
+    busy_map = {t: get_busy_map(t, temp_payloads[t]) for t in selected_teachers}
 
-    rows = []
-    for idx, row_data in data.items():
-        if idx in deleted:
-            continue
-        row = {col: row_data.get(col, '') for col in columns}
-        rows.append(row)
+    # Union of everyone's busy minutes for the day
+    combined = np.bitwise_or.reduce([busy_map[t][day] for t in selected_teachers])
+    day_intervals = busy_intervals(combined)
 
-    new_df = pd.DataFrame(rows, columns=columns)
-    temp_sheets[(faculty, date_str)] = new_df
+    # === 1. Search in preferred window ===
+    result_list = find_free_slots(day_intervals, ws_min, we_min, duration)
 
-    return render_template("select_faculty.html", teachers=session['selected_teachers'])
+    # === 2. If no slots, search extended window (±2 hours) ===
+    if not result_list:
+        EXTEND_MINUTES = 120
+        search_start = max(0, ws_min - EXTEND_MINUTES)
+        search_end = min(24*60, we_min + EXTEND_MINUTES)
+
+        free = np.array(find_free_slots(day_intervals, search_start, search_end, duration), dtype=int).reshape(-1, 2)
+
+        # Pick the 5 closest to the window centre (twice the distance, to stay integral);
+        # folding the position into the key keeps ties on the earlier slot
+        distance = np.abs(2 * free[:, 0] + duration - (ws_min + we_min))
+        order = distance * len(free) + np.arange(len(free))
+        k = min(5, len(free))
+        if k:
+            free = free[np.argpartition(order, k - 1)[:k]]
+
+        # Sort by start time for display
+        alternative_slots = sorted(map(tuple, free.tolist()))
+
+    return result_list, alternative_slots
+
+def slot_cache_key(*args, temp_payloads):
+    """Fingerprint of a slot search, including the workbook and temporary edits it depends on."""
+    edits = {t: hashlib.sha1(p).hexdigest() for t, p in temp_payloads.items() if p is not None}
+    payload = json.dumps([sheets_fingerprint, args, edits], sort_keys=True)
+    return "slots:" + hashlib.sha1(payload.encode()).hexdigest()
 
 @app.route("/process")
 def process():
-    clear_expired_temp_sheets()
     form_data = session.get('form_data')
     if not form_data:
         return redirect(url_for("index"))
@@ -179,61 +386,17 @@ def process():
         if ws_min is None or we_min is None or we_min <= ws_min:
             raise ValueError("Invalid time window (start must be before end).")
 
-        # Build busy maps
-        busy_map = {}
-        for t in selected_teachers:
-            df = temp_sheets.get((t, date_str), sheets[t])
-            busy_map[t] = build_busy_map(df)
-
-        # === 1. Search in preferred window ===
-        for start in range(ws_min, we_min - duration + 1, 15):
-            end = start + duration
-            conflict = False
-            for t in selected_teachers:
-                for s, e in busy_map[t].get(day, []):
-                    if not (end <= s or start >= e):
-                        conflict = True
-                        break
-                if conflict:
-                    break
-            if not conflict:
-                result_list.append((start, end))
-
-        # === 2. If no slots, search extended window (±2 hours) ===
-        if not result_list:
-            EXTEND_MINUTES = 120
-            search_start = max(0, ws_min - EXTEND_MINUTES)
-            search_end = min(24*60, we_min + EXTEND_MINUTES)
-
-            candidates = []
-            for start in range(search_start, search_end - duration + 1, 15):
-                end = start + duration
-                conflict = False
-                for t in selected_teachers:
-                    for s, e in busy_map[t].get(day, []):
-                        if not (end <= s or start >= e):
-                            conflict = True
-                            break
-                    if conflict:
-                        break
-                if not conflict:
-                    center_user = (ws_min + we_min) / 2
-                    center_slot = (start + end) / 2
-                    distance = abs(center_slot - center_user)
-                    candidates.append((distance, start, end))
-
-            # Sort by closeness → pick top 5
-            candidates.sort(key=lambda x: x[0])
-            closest_5 = [(s, e) for _, s, e in candidates[:5]]
-
-            # Sort by start time for display
-            closest_5.sort(key=lambda x: x[0])
-
-            alternative_slots = closest_5
+        temp_payloads = get_temp_payloads(selected_teachers, date_str)
+        cache_key = slot_cache_key(selected_teachers, day, duration, ws_min, we_min, temp_payloads=temp_payloads)
+        cached = cache.get(cache_key)
+        if cached is None:
+            cached = search_slots(selected_teachers, temp_payloads, day, duration, ws_min, we_min)
+            cache.set(cache_key, cached)
+        result_list, alternative_slots = cached
 
         # Format results
-        result_list = [{"Start": to_hhmm(s), "End": to_hhmm(e)} for s, e in result_list]
-        alternative_slots = [{"Start": to_hhmm(s), "End": to_hhmm(e)} for s, e in alternative_slots]
+        result_list = [{"Start": HHMM_TABLE[s], "End": HHMM_TABLE[e]} for s, e in result_list]
+        alternative_slots = [{"Start": HHMM_TABLE[s], "End": HHMM_TABLE[e]} for s, e in alternative_slots]
 
     except Exception as e:
         error = f"Error processing request: {str(e)}"
@@ -1,12 +1,25 @@
+import numpy as np
 import pandas as pd
 import datetime
 import logging
+import re
+from functools import lru_cache
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the kernels below then run as plain Python
+    def njit(*args, **kwargs):
+        return lambda f: f
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Define expected_columns at module level
 expected_columns = ["START TIME", "END TIME", "MONDAY", "TUESDAY", "WEDNESDAY", "THURSDAY", "FRIDAY", "SATURDAY"]
+MINUTES_PER_DAY = 24 * 60
+
+# "H:MM", "H:MM:SS", optionally followed by AM/PM
+TIME_RE = re.compile(r"(\d{1,2}):(\d{1,2})(?::(\d{1,2}))?(?:\s+([AaPp][Mm]))?", re.ASCII)
 
 def time_to_minutes(t):
     if pd.isna(t):
@@ -15,37 +28,111 @@ def time_to_minutes(t):
         return t.hour * 60 + t.minute
     if isinstance(t, datetime.time):
         return t.hour * 60 + t.minute
-    t_str = str(t).strip()
+    return parse_time_str(str(t).strip())
+
+@lru_cache(maxsize=4096)
+def parse_time_str(t_str):
+    """Parse a stripped time string; timetables repeat the same few strings, so results are memoized."""
     if t_str == "":
         return None
-    for fmt in ("%I:%M %p", "%I:%M:%S %p", "%H:%M", "%H:%M:%S"):
-        try:
-            dt = datetime.datetime.strptime(t_str, fmt)
-            return dt.hour * 60 + dt.minute
-        except ValueError:
-            continue
+    m = TIME_RE.fullmatch(t_str)
+    if m:
+        hour, minute = int(m[1]), int(m[2])
+        seconds_ok = m[3] is None or int(m[3]) <= 59
+        if m[4]:
+            hour_ok = 1 <= hour <= 12
+            hour = hour % 12 + (12 if m[4].upper() == "PM" else 0)
+        else:
+            hour_ok = hour <= 23
+        if hour_ok and minute <= 59 and seconds_ok:
+            return hour * 60 + minute
     try:
-        f = float(t)
+        f = float(t_str)
         minutes = int(f * 24 * 60)
         return minutes
     except:
         pass
-    logger.warning(f"Cannot parse time: {t}")
+    logger.warning(f"Cannot parse time: {t_str}")
     return None
 
+def column_to_minutes(col):
+    """Vectorised time_to_minutes over a Series; unparseable cells become NaN.
+
+    Each distinct cell is parsed once with time_to_minutes, so the column and
+    scalar paths share one grammar.
+    """
+    codes, uniques = pd.factorize(col.to_numpy(dtype=object))
+    minutes = np.array([time_to_minutes(u) for u in uniques] + [None], dtype=float)
+    return minutes[codes]  # code -1 (missing) picks the trailing NaN
+
+def filled_cells(df, columns):
+    """Boolean (rows, columns) array, True where a cell holds non-blank text."""
+    cells = np.column_stack([df[col].to_numpy(dtype=object) for col in columns])
+    codes, uniques = pd.factorize(cells.ravel())
+    filled = np.array([str(u).strip() != "" for u in uniques] + [False])
+    return filled[codes].reshape(cells.shape)
+
 def build_busy_map(df):
     if not all(col in df.columns for col in expected_columns):
         raise ValueError(f"Excel sheet missing required columns: {expected_columns}")
     
-    busy = {day.upper(): [] for day in expected_columns[2:]}
-    for idx, row in df.iterrows():
-        start = time_to_minutes(row["START TIME"])
-        end = time_to_minutes(row["END TIME"])
-        if start is None or end is None or end <= start:
-            logger.warning(f"Skipping invalid row {idx}: start={row['START TIME']}, end={row['END TIME']}")
+    starts = column_to_minutes(df["START TIME"])
+    ends = column_to_minutes(df["END TIME"])
+    valid = ~np.isnan(starts) & ~np.isnan(ends) & (ends > starts)
+    for idx in df.index[~valid]:
+        logger.warning(f"Skipping invalid row {idx}: start={df.at[idx, 'START TIME']}, end={df.at[idx, 'END TIME']}")
+
+    days = expected_columns[2:]
+    filled = filled_cells(df, days) & valid[:, None]
+    busy = {}
+    for i, day in enumerate(days):
+        mask = filled[:, i]
+        busy[day.upper()] = busy_minutes(starts[mask].astype(int), ends[mask].astype(int))
+    return busy
+
+
+def busy_minutes(starts, ends):
+    """Mark busy minutes of the day: one uint8 per minute, 1 where any interval covers it."""
+    diff = np.zeros(MINUTES_PER_DAY + 1, dtype=int)
+    np.add.at(diff, np.clip(starts, 0, MINUTES_PER_DAY), 1)
+    np.add.at(diff, np.clip(ends, 0, MINUTES_PER_DAY), -1)
+    return (np.cumsum(diff[:-1]) > 0).astype(np.uint8)
+
+def busy_intervals(minutes):
+    """Turn a busy-minute vector back into a sorted, disjoint (N, 2) array of intervals."""
+    edges = np.diff(minutes.astype(np.int8), prepend=0, append=0)
+    return np.column_stack((np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+@njit(cache=True)
+def free_slot_starts(merged, search_start, search_end, duration, step):
+    """Sweep the gaps between merged busy intervals, returning every slot start that fits."""
+    out = np.empty(max(0, (search_end - duration - search_start) // step + 1), dtype=np.int64)
+    n = 0
+    gap_start = search_start
+    for i in range(merged.shape[0] + 1):
+        if i < merged.shape[0]:
+            s, e = merged[i, 0], merged[i, 1]
+        else:
+            s, e = search_end, search_end
+        if e <= gap_start:
             continue
-        for day in busy.keys():
-            lecture = row[day]
-            if pd.notna(lecture) and str(lecture).strip() != "":
-                busy[day].append((start, end))
-    return busy
\ No newline at end of file
+        gap_end = min(s, search_end)
+        start = search_start + -(-(gap_start - search_start) // step) * step
+        while start + duration <= gap_end:
+            out[n] = start
+            n += 1
+            start += step
+        gap_start = e
+        if gap_start >= search_end:
+            break
+    return out[:n]
+
+def find_free_slots(merged, search_start, search_end, duration, step=15):
+    """Return (start, end) slots of the given duration that overlap none of the busy intervals.
+
+    merged must be sorted and disjoint, as returned by busy_intervals(). Slot
+    starts stay aligned to search_start in multiples of step.
+    """
+    merged = np.asarray(merged, dtype=np.int64).reshape(-1, 2)
+    starts = free_slot_starts(merged, search_start, search_end, duration, step)
+    return list(zip(starts.tolist(), (starts + duration).tolist()))